@@ -1 +1,43 @@
 CACHE_SIZE = 128
+
+# Amount of data to fetch per HTTP range request for reads that are not
+# sequential.  Kept small since such reads tend to be for metadata records,
+# which a larger block would only delay.
+BLOCK_SIZE = 2**20
+
+# Amount of data to fetch per HTTP range request ahead of a sequential reader.
+# FUSE reads in much smaller chunks, so a larger block means fewer round-trips
+# per MB streamed.
+PREFETCH_BLOCK_SIZE = 16 * 2**20
+
+# Maximum number of blocks to fetch ahead of a sequential reader
+PREFETCH_BLOCKS = 2
+
+# Number of candidate URLs for a file to check for existence concurrently
+PROBE_URLS = 4
+
+# Maximum number of files per dataset to keep git-annex information about
+# across mounts
+STATE_CACHE_SIZE = 2**20
+
+# Maximum number of file states determined while listing directories to hold
+# on to until they are looked up
+PRIMED_STATES_SIZE = 2**16
+
+# How long to keep idle HTTP connections open for reuse, in seconds
+KEEPALIVE_TIMEOUT = 60
+
+# How long to cache DNS lookups of remote hosts, in seconds
+DNS_CACHE_TTL = 300
+
+# Number of content presence checks in a dataset after which the annex object
+# directory gets scanned instead of checking each file
+PRESENT_KEYS_MIN_LOOKUPS = 1000
+
+# Minimum interval between checks for whether git-annex's state changed since
+# the object directory was scanned, in seconds
+PRESENT_KEYS_CHECK_INTERVAL = 1
+
+# Maximum number of annex keys per dataset to remember a working URL for, and
+# of URLs to remember the size of
+URL_CACHE_SIZE = 2**14
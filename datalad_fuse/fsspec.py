@@ -1,57 +1,160 @@
 from __future__ import annotations
 
 from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timezone
 from enum import Enum
+import json
 import logging
 import os
 import os.path
 from pathlib import Path
+import sqlite3
+import stat
+from threading import Thread
+import time
 from types import SimpleNamespace, TracebackType
 from typing import IO, Any, Optional, Tuple, cast
 
 import aiohttp
 from aiohttp_retry import ListRetry, RetryClient
 from datalad.distribution.dataset import Dataset
-from datalad.support.annexrepo import AnnexRepo
-from datalad.utils import get_dataset_root
+from datalad.support.annexrepo import AnnexRepo, BatchedAnnex
 from fsspec.exceptions import BlocksizeMismatchError
 from fsspec.implementations.cached import CachingFileSystem
-from fsspec.implementations.http import HTTPFileSystem
+from fsspec.implementations.http import HTTPFile, HTTPFileSystem
 import methodtools
 
-from .consts import CACHE_SIZE
+from .consts import (
+    BLOCK_SIZE,
+    CACHE_SIZE,
+    DNS_CACHE_TTL,
+    KEEPALIVE_TIMEOUT,
+    PREFETCH_BLOCK_SIZE,
+    PREFETCH_BLOCKS,
+    PRESENT_KEYS_CHECK_INTERVAL,
+    PRESENT_KEYS_MIN_LOOKUPS,
+    PRIMED_STATES_SIZE,
+    PROBE_URLS,
+    URL_CACHE_SIZE,
+)
+from .state_cache import StateCache
 from .utils import AnnexKey, is_annex_dir_or_key
 
 lgr = logging.getLogger("datalad.fuse.fsspec")
 
+# What the content of an unlocked annexed file without content starts with
+POINTER_PREFIX = b"/annex/objects/"
+
 FileState = Enum("FileState", "NOT_ANNEXED NO_CONTENT HAS_CONTENT")
 
 
 class DatasetAdapter:
     def __init__(
-        self, path: str | Path, caching: bool, mode_transparent: bool = False
+        self,
+        path: str | Path,
+        caching: bool,
+        mode_transparent: bool = False,
+        block_size: int = BLOCK_SIZE,
+        cache_type: str = "bytes",
     ) -> None:
-        self.path = Path(path)
+        self.path = os.fspath(path)
+        # Where the targets of annexed symlinks live
+        self.objects_prefix = os.path.join(self.path, ".git", "annex", "objects", "")
         self.mode_transparent = mode_transparent
         ds = Dataset(path)
         self.annex: Optional[AnnexRepo]
+        # Long-lived `git annex examinekey` processes for composing object
+        # paths under the two hashing layouts, keyed by layout name
+        self.examinekey: dict[str, BatchedAnnex] = {}
+        # Long-lived `git annex find` process used by `annex_find()`
+        self.find: Optional[BatchedAnnex] = None
+        # Whether files are expected to be added unlocked, in which case every
+        # small regular file could be an annexed one with content present
+        self.expect_unlocked = False
         if isinstance(ds.repo, AnnexRepo):
             self.annex = ds.repo
+            # Where git-annex actually keeps the objects, which differs from
+            # `objects_prefix` when .git is a file
+            self.objects_dir = os.path.join(str(self.annex.dot_git), "annex", "objects")
+            # Which of the `git annex find` hash directory fields gives the
+            # location of objects in this repository
+            if self.annex.config.getbool("annex", "tune.objecthashlower", False):
+                self.hashdir = "hashdirlower"
+            else:
+                self.hashdir = "hashdirmixed"
+            for hashdir in ("hashdirmixed", "hashdirlower"):
+                self.examinekey[hashdir] = self.annex._batched.get(
+                    "examinekey",
+                    annex_options=[
+                        "--format=annex/objects/${%s}${key}/${key}\\n" % hashdir
+                    ],
+                    path=self.annex.path,
+                )
+            self.find = self.annex._batched.get(
+                "find",
+                annex_options=["--include=*"],
+                json=True,
+                path=self.annex.path,
+                # Since we are just interested in local information
+                git_options=["-c", "annex.merge-annex-branches=false"],
+            )
+            addunlocked = self.annex.config.get("annex.addunlocked")
+            self.expect_unlocked = self.annex.is_managed_branch() or (
+                addunlocked is not None
+                and addunlocked.lower() not in ("false", "no", "off", "0")
+            )
         else:
             self.annex = None
         self.commit_dt = datetime.fromtimestamp(
             ds.repo.get_commit_date(), tz=timezone.utc
         )
         self.caching = caching
-        fs = HTTPFileSystem(get_client=get_client)
+        cache_dir = os.path.join(path, ".git", "datalad", "cache")
+        # Mapping from annex keys to the URL that was last successfully opened
+        # for them; persisted across mounts when caching on disk
+        self.url_cache_file = os.path.join(cache_dir, "fsspec-urls.json")
+        self.good_urls: dict[str, str] = {}
+        self.good_urls_dirty = False
+        # Sizes of files at URLs which are known to exist and to support
+        # range requests
+        self.url_sizes: dict[str, int] = {}
+        # File states determined by prime_dir() that have not been looked up
+        # via get_file_state() yet
+        self.primed_states: dict[str, tuple[FileState, Optional[AnnexKey]]] = {}
+        # Thread pool for PrefetchingFile; created on first use
+        self.executor: Optional[ThreadPoolExecutor] = None
+        # Thread pool for probing URLs, kept apart from the above so that
+        # opening a file (which DataLadFUSE does under a global lock) never
+        # waits for block downloads; created on first use
+        self.probe_executor: Optional[ThreadPoolExecutor] = None
+        # Filenames of the keys with content present, as found by
+        # scan_present_keys() when git-annex's state was `present_keys_stamp`;
+        # None until scanned
+        self.present_keys: Optional[frozenset[str]] = None
+        self.present_keys_stamp: tuple[Optional[int], ...] = ()
+        # When `present_keys_stamp` was last compared to the current state
+        self.present_keys_checked = 0.0
+        # Number of presence checks made by stat()ing since `present_keys` was
+        # last discarded
+        self.present_keys_lookups = 0
+        self.present_keys_scan: Optional[Thread] = None
+        fs = HTTPFileSystem(
+            get_client=get_client, block_size=block_size, cache_type=cache_type
+        )
+        # What git-annex said about unlocked files, persisted across mounts
+        # when caching on disk; opened by get_state_cache() on first use
+        self.state_cache: Optional[StateCache] = None
+        self.state_cache_file: Optional[str] = None
         if self.caching:
+            self.good_urls = load_url_cache(self.url_cache_file)
+            if self.annex is not None:
+                self.state_cache_file = os.path.join(cache_dir, "state.sqlite")
             self.fs = CachingFileSystem(
                 fs=fs,
                 # target_protocol='blockcache',
-                cache_storage=os.path.join(path, ".git", "datalad", "cache", "fsspec"),
+                cache_storage=os.path.join(cache_dir, "fsspec"),
                 # cache_check=600,
-                # block_size=1024,
                 # check_files=True,
                 # expiry_times=True,
                 # same_names=True
@@ -59,45 +162,296 @@ class DatasetAdapter:
         else:
             self.fs = fs
 
+    def __enter__(self) -> DatasetAdapter:
+        return self
+
+    def __exit__(
+        self,
+        _exc_type: Optional[type[BaseException]],
+        _exc_val: Optional[BaseException],
+        _exc_tb: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
     def close(self) -> None:
         if self.annex is not None:
             self.annex._batched.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.probe_executor is not None:
+            self.probe_executor.shutdown(wait=False)
+            self.probe_executor = None
+        if self.caching and self.good_urls_dirty:
+            save_url_cache(self.url_cache_file, self.good_urls)
+            self.good_urls_dirty = False
+        if self.state_cache is not None:
+            self.state_cache.close()
+            self.state_cache = None
 
     @methodtools.lru_cache(maxsize=CACHE_SIZE)
     def get_file_state(self, relpath: str) -> tuple[FileState, Optional[AnnexKey]]:
-        p = self.path / relpath
+        try:
+            return self.primed_states.pop(relpath)
+        except KeyError:
+            pass
+        p = os.path.join(self.path, relpath)
         lgr.debug("get_file_state: %s", relpath)
 
-        def handle_path_under_annex_objects(
-            p: Path,
-        ) -> tuple[FileState, Optional[AnnexKey]]:
-            iadok = is_annex_dir_or_key(p)
-            if isinstance(iadok, AnnexKey):
-                if p.exists():
-                    return (FileState.HAS_CONTENT, iadok)
-                else:
-                    return (FileState.NO_CONTENT, iadok)
-            else:
-                return (FileState.NOT_ANNEXED, None)
-
         # Shortcut handling of content under .git, in particular - annex key paths
         if self.mode_transparent and relpath.startswith(".git/"):
-            return handle_path_under_annex_objects(p)
+            return annex_path_state(p)
 
+        st = os.lstat(p)
         # A regular file or git link for which we need to explicitly ask annex about
-        if not p.is_symlink():
-            if p.stat().st_size < 1024 and self.annex is not None:
-                if self.annex.is_under_annex(relpath, batch=True):
-                    key = AnnexKey.parse(self.annex.get_file_key(relpath, batch=True))
-                    if self.annex.file_has_content(relpath, batch=True):
-                        return (FileState.HAS_CONTENT, key)
-                    else:
-                        return (FileState.NO_CONTENT, key)
+        if not stat.S_ISLNK(st.st_mode):
+            if self.may_be_unlocked(p, st):
+                info = None
+                state_cache = self.get_state_cache()
+                if state_cache is not None:
+                    info = state_cache.get(relpath, st)
+                if info is None:
+                    (info,) = self.annex_find([relpath])
+                    if state_cache is not None:
+                        state_cache.set(relpath, st, info)
+                return self.annexinfo_state(info)
             return (FileState.NOT_ANNEXED, None)
 
-        return handle_path_under_annex_objects(
-            Path(os.path.normpath(p.parent / os.readlink(p)))
+        return self.symlink_state(p)
+
+    def get_state_cache(self) -> Optional[StateCache]:
+        """
+        Return the on-disk cache of git-annex's answers about unlocked files,
+        opening it on first use, or `None` if not caching on disk
+        """
+        if self.state_cache is None and self.state_cache_file is not None:
+            try:
+                self.state_cache = StateCache(self.state_cache_file)
+            except sqlite3.Error as e:
+                lgr.warning("Could not open file state cache: %s", e)
+                self.state_cache_file = None
+        return self.state_cache
+
+    def may_be_unlocked(self, p: str, st: os.stat_result) -> bool:
+        """
+        Tell whether the regular file at ``p`` could be an unlocked annexed
+        file and thus needs to be asked about.  Unless unlocked files are
+        expected in the dataset, only those with content that looks like an
+        annex pointer (i.e., unlocked files without content) qualify.
+        """
+        if st.st_size >= 1024 or self.annex is None:
+            return False
+        return self.expect_unlocked or is_pointer_file(p)
+
+    def symlink_state(self, p: str) -> tuple[FileState, Optional[AnnexKey]]:
+        target = os.path.normpath(os.path.join(os.path.dirname(p), os.readlink(p)))
+        if target.startswith(self.objects_prefix):
+            # The usual layout of <hashdir1>/<hashdir2>/<key>/<key>, which can
+            # be handled without the generic parsing
+            parts = target[len(self.objects_prefix) :].split(os.sep)
+            if len(parts) == 4 and parts[2] == parts[3]:
+                try:
+                    key = AnnexKey.parse_filename(parts[3])
+                except ValueError:
+                    return (FileState.NOT_ANNEXED, None)
+                if self.has_content(parts[3], target):
+                    return (FileState.HAS_CONTENT, key)
+                else:
+                    return (FileState.NO_CONTENT, key)
+        return annex_path_state(target)
+
+    def annexinfo_state(
+        self, info: dict[str, str]
+    ) -> tuple[FileState, Optional[AnnexKey]]:
+        """Determine the state of a file from its `annex_find()` output"""
+        if not info:
+            return (FileState.NOT_ANNEXED, None)
+        assert self.annex is not None
+        key = AnnexKey.parse(info["key"])
+        # Content presence is a local matter, so check for the object file
+        # instead of asking git-annex once more
+        keyfile = key.to_filename()
+        objpath = os.path.join(self.objects_dir, info[self.hashdir], keyfile, keyfile)
+        if self.has_content(keyfile, objpath):
+            return (FileState.HAS_CONTENT, key)
+        else:
+            return (FileState.NO_CONTENT, key)
+
+    def has_content(self, keyfile: str, objpath: str) -> bool:
+        """
+        Tell whether the content of the key with filename ``keyfile`` and
+        object file ``objpath`` is present.
+
+        After `PRESENT_KEYS_MIN_LOOKUPS` checks, which are made by ``stat``-ing
+        the object file, the annex object directory is scanned in the
+        background, and the set of present keys is consulted instead from then
+        on until git-annex's state changes.
+        """
+        if self.annex is None:
+            return os.path.exists(objpath)
+        present = self.present_keys
+        if present is not None:
+            now = time.monotonic()
+            if now - self.present_keys_checked >= PRESENT_KEYS_CHECK_INTERVAL:
+                self.present_keys_checked = now
+                if self.annex_state_stamp() != self.present_keys_stamp:
+                    lgr.debug("git-annex state changed; discarding present keys")
+                    present = self.present_keys = None
+                    self.present_keys_lookups = 0
+        if present is not None:
+            return keyfile in present
+        self.present_keys_lookups += 1
+        if (
+            self.present_keys_lookups >= PRESENT_KEYS_MIN_LOOKUPS
+            and self.present_keys_scan is None
+        ):
+            # A daemon thread, so that exiting does not wait for the scan
+            self.present_keys_scan = Thread(
+                target=self.scan_present_keys,
+                name="datalad-fuse-keyscan",
+                daemon=True,
+            )
+            self.present_keys_scan.start()
+        return os.path.exists(objpath)
+
+    def annex_state_stamp(self) -> tuple[Optional[int], ...]:
+        """
+        Return the modification times of git-annex's index and journal, at
+        least one of which changes whenever content is obtained or dropped
+        """
+        assert self.annex is not None
+        stamp: list[Optional[int]] = []
+        for name in ("index", "journal"):
+            try:
+                stamp.append(
+                    os.stat(os.path.join(self.annex.dot_git, "annex", name)).st_mtime_ns
+                )
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def scan_present_keys(self) -> None:
+        """
+        Collect the filenames of all keys whose object files exist in the
+        annex object directory into `present_keys`
+        """
+        stamp = self.annex_state_stamp()
+        keys: set[str] = set()
+        try:
+            for d1 in os.scandir(self.objects_dir):
+                if not d1.is_dir():
+                    continue
+                for d2 in os.scandir(d1.path):
+                    if not d2.is_dir():
+                        continue
+                    for e in os.scandir(d2.path):
+                        if os.path.exists(os.path.join(e.path, e.name)):
+                            keys.add(e.name)
+        except FileNotFoundError:
+            # No content at all yet, or a directory got removed while
+            # scanning; in the latter case, try again later
+            if os.path.exists(self.objects_dir):
+                self.present_keys_lookups = 0
+                self.present_keys_scan = None
+                return
+        except OSError as e:
+            # Leave `present_keys_scan` set so that no further scans are
+            # attempted and presence is checked per file from now on
+            lgr.warning("Could not scan %s: %s", self.objects_dir, e)
+            return
+        lgr.debug("Found %d keys with content present", len(keys))
+        self.present_keys_stamp = stamp
+        self.present_keys_checked = time.monotonic()
+        self.present_keys = frozenset(keys)
+        self.present_keys_scan = None
+
+    def annex_find(self, relpaths: list[str]) -> list[dict[str, str]]:
+        """
+        Query ``git annex find`` for files regardless of whether their content
+        is present.  An empty dict is returned for each file that is not
+        annexed.
+        """
+        assert self.find is not None
+        infos = self.find(relpaths)
+        assert isinstance(infos, list)
+        return infos
+
+    def prime_dir(self, reldir: str) -> None:
+        """
+        Determine the states of all files in a directory in one go, so that
+        the `get_file_state()` calls that typically follow a directory listing
+        need not touch the filesystem or git-annex one file at a time.
+        Symlinks are resolved right away, while the small regular files (which
+        might be unlocked annexed files) are sent to git-annex in a single
+        batch.
+
+        Only files without content are remembered: those are the ones that
+        `DataLadFUSE` asks about, and a file thought to lack content that got
+        obtained in the meantime still reads fine (via its URLs), whereas one
+        thought to have content that got dropped would not.
+        """
+        if reldir == ".git" or reldir.startswith(".git/"):
+            return
+        states: dict[str, tuple[FileState, Optional[AnnexKey]]] = {}
+        pending: list[tuple[str, os.stat_result]] = []
+        state_cache = self.get_state_cache()
+        with os.scandir(os.path.join(self.path, reldir)) as entries:
+            for entry in entries:
+                if entry.name == ".git":
+                    continue
+                relpath = os.path.normpath(os.path.join(reldir, entry.name))
+                if entry.is_symlink():
+                    states[relpath] = self.symlink_state(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    info: Optional[dict[str, str]] = None
+                    if not self.may_be_unlocked(entry.path, st):
+                        info = {}
+                    elif state_cache is not None:
+                        info = state_cache.get(relpath, st)
+                    if info is None:
+                        pending.append((relpath, st))
+                    else:
+                        states[relpath] = self.annexinfo_state(info)
+        if pending:
+            infos = self.annex_find([relpath for relpath, _ in pending])
+            for (relpath, st), info in zip(pending, infos):
+                if state_cache is not None:
+                    state_cache.set(relpath, st, info)
+                states[relpath] = self.annexinfo_state(info)
+        self.primed_states.update(
+            (relpath, state)
+            for relpath, state in states.items()
+            if state[0] is FileState.NO_CONTENT
         )
+        # Drop the oldest entries that never got looked up
+        trim_dict(self.primed_states, PRIMED_STATES_SIZE)
+
+    @methodtools.lru_cache(maxsize=1)
+    def get_remote_urls(self) -> dict[str, tuple[str, bool]]:
+        """
+        Return a mapping from the UUIDs of remotes with HTTP(S) URLs to pairs
+        of their (rewritten) URLs, without any trailing slashes, and whether
+        the URL points to a :file:`.git` directory.  Remote configuration does
+        not change while mounted, so this is computed only once.
+        """
+        assert self.annex is not None
+        uuid2remote_url = {}
+        for r in self.annex.get_remotes():
+            ru = self.annex.config.get(f"remote.{r}.annex-uuid")
+            if ru is None:
+                continue
+            remote_url = self.annex.config.get(f"remote.{r}.url")
+            if remote_url is None:
+                continue
+            remote_url = self.annex.config.rewrite_url(remote_url).rstrip("/")
+            if not is_http_url(remote_url):
+                continue
+            uuid2remote_url[ru] = (
+                remote_url,
+                remote_url.lower().endswith("/.git"),
+            )
+        return uuid2remote_url
 
     def get_urls(self, key: str) -> Iterator[str]:
         assert self.annex is not None
@@ -105,52 +459,135 @@ class DatasetAdapter:
         # https://github.com/datalad/datalad/pull/6379 is merged/released.
         # Will need a recent git-annex to work!
         whereis = self.annex.whereis(key, output="full", batch=False, key=True)
-        remote_uuids = []
+        uuid2remote_url = self.get_remote_urls()
+        remotes = []
         for ru, v in whereis.items():
-            remote_uuids.append(ru)
+            if ru in uuid2remote_url:
+                remotes.append(uuid2remote_url[ru])
             for u in v["urls"]:
                 if is_http_url(u):
                     yield u
+        if not remotes:
+            # Spare the examinekey round-trips
+            return
 
-        path_mixed = self.annex._batched.get(
-            "examinekey",
-            annex_options=["--format=annex/objects/${hashdirmixed}${key}/${key}\\n"],
-            path=self.annex.path,
-        )(key)
-        path_lower = self.annex._batched.get(
-            "examinekey",
-            annex_options=["--format=annex/objects/${hashdirlower}${key}/${key}\\n"],
-            path=self.annex.path,
-        )(key)
+        path_mixed = self.examinekey["hashdirmixed"](key)
+        path_lower = self.examinekey["hashdirlower"](key)
+        git_paths = (f"/{path_mixed}", f"/{path_lower}")
+        worktree_paths = (
+            f"/{path_lower}",
+            f"/{path_mixed}",
+            f"/.git/{path_lower}",
+            f"/.git/{path_mixed}",
+        )
+        for base_url, is_git_dir in remotes:
+            for p in git_paths if is_git_dir else worktree_paths:
+                yield base_url + p
 
-        uuid2remote_url = {}
-        for r in self.annex.get_remotes():
-            ru = self.annex.config.get(f"remote.{r}.annex-uuid")
-            if ru is None:
-                continue
-            remote_url = self.annex.config.get(f"remote.{r}.url")
-            if remote_url is None:
-                continue
-            remote_url = self.annex.config.rewrite_url(remote_url)
-            uuid2remote_url[ru] = remote_url
+    @methodtools.lru_cache(maxsize=CACHE_SIZE)
+    def get_url_list(self, key: str) -> tuple[str, ...]:
+        return tuple(self.get_urls(key))
 
-        for ru in remote_uuids:
-            try:
-                base_url = uuid2remote_url[ru]
-            except KeyError:
-                continue
-            if is_http_url(base_url):
-                if base_url.lower().rstrip("/").endswith("/.git"):
-                    paths = [path_mixed, path_lower]
+    def iter_urls(self, key: str) -> Iterator[str]:
+        """
+        Yield candidate URLs for a key, starting with the one that last worked
+        so that the full list needs to be computed only if that one fails.
+        The remaining candidates are passed through `probe_urls()`.
+        """
+        good_url = self.good_urls.get(key)
+        if good_url is not None:
+            yield good_url
+        yield from self.probe_urls(
+            [url for url in self.get_url_list(key) if url != good_url]
+        )
+
+    def probe_urls(self, urls: list[str]) -> Iterator[str]:
+        """
+        Check the first `PROBE_URLS` of the given URLs for existence
+        concurrently, and yield those that exist, in the given order, followed
+        by the remaining URLs unchecked.  The result of waiting for each probe
+        in turn is about one round-trip rather than one per nonexistent URL.
+
+        When caching, the URLs are not probed, as `CachingFileSystem` makes
+        its own request for the size of the file when opening it.
+        """
+        if len(urls) < 2 or self.caching:
+            yield from urls
+            return
+        if self.probe_executor is None:
+            self.probe_executor = ThreadPoolExecutor(
+                max_workers=PROBE_URLS, thread_name_prefix="datalad-fuse-probe"
+            )
+        executor = self.probe_executor
+        probes = [
+            (url, executor.submit(self.fs.info, url)) for url in urls[:PROBE_URLS]
+        ]
+        try:
+            for url, fut in probes:
+                try:
+                    info = fut.result()
+                except FileNotFoundError as e:
+                    lgr.debug("URL %s does not exist: %s", url, e)
+                    continue
+                except Exception as e:
+                    # Let the actual open() attempt deal with it
+                    lgr.debug("Failed to probe URL %s: %s", url, e)
                 else:
-                    paths = [
-                        path_lower,
-                        path_mixed,
-                        f".git/{path_lower}",
-                        f".git/{path_mixed}",
-                    ]
-                for p in paths:
-                    yield base_url.rstrip("/") + "/" + p
+                    if info.get("size") and info.get("partial", True):
+                        self.set_url_size(url, info["size"])
+                yield url
+        finally:
+            for _, fut in probes:
+                fut.cancel()
+        yield from urls[PROBE_URLS:]
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=PREFETCH_BLOCKS,
+                thread_name_prefix="datalad-fuse",
+            )
+        return self.executor
+
+    def set_good_url(self, key: str, url: Optional[str]) -> None:
+        """
+        Record the URL that worked for a key, or forget it if ``url`` is
+        `None`, keeping only the `URL_CACHE_SIZE` most recently used keys
+        """
+        old_url = self.good_urls.pop(key, None)
+        if url is not None:
+            self.good_urls[key] = url
+            trim_dict(self.good_urls, URL_CACHE_SIZE)
+        if old_url != url:
+            self.good_urls_dirty = True
+
+    def set_url_size(self, url: str, size: int) -> None:
+        """
+        Record the size of the file at a URL, keeping only the
+        `URL_CACHE_SIZE` most recently recorded URLs
+        """
+        self.url_sizes.pop(url, None)
+        self.url_sizes[url] = size
+        trim_dict(self.url_sizes, URL_CACHE_SIZE)
+
+    def forget_url(self, key: str, url: str) -> None:
+        """Forget that a URL worked for a key, along with its recorded size"""
+        self.set_good_url(key, None)
+        self.url_sizes.pop(url, None)
+
+    def open_url(
+        self, relpath: str, url: str, mode: str, open_kwargs: dict[str, Any]
+    ) -> Any:
+        try:
+            return self.fs.open(url, mode, **open_kwargs)
+        except BlocksizeMismatchError as e:
+            lgr.warning(
+                "%s: Blocksize mismatch: %s; deleting cached file and re-opening",
+                relpath,
+                e,
+            )
+            self.fs.pop_from_cache(url)
+            return self.fs.open(url, mode, **open_kwargs)
 
     def open(
         self,
@@ -158,7 +595,13 @@ class DatasetAdapter:
         mode: str = "rb",
         encoding: str = "utf-8",
         errors: Optional[str] = None,
+        prefetch: bool = False,
     ) -> IO:
+        """
+        If ``prefetch`` is true, binary files read over HTTP without on-disk
+        caching are wrapped in a `PrefetchingFile`, which only supports
+        ``seek()``, ``read()``, ``info()``, and ``close()``.
+        """
         if mode not in ("r", "rb", "rt"):
             raise NotImplementedError("Only modes 'r', 'rb', and 'rt' are supported")
         if mode == "rb":
@@ -176,43 +619,95 @@ class DatasetAdapter:
             )
         if fstate is FileState.NO_CONTENT:
             lgr.debug("%s: opening via fsspec", relpath)
-            for url in self.get_urls(str(key)):
+            skey = str(key)
+            for url in self.iter_urls(skey):
+                open_kwargs: dict[str, Any] = dict(kwargs)
+                if not self.caching and url in self.url_sizes:
+                    # Spare the HEAD request fsspec would otherwise make to
+                    # learn the size.  CachingFileSystem keeps track of sizes
+                    # on its own.
+                    open_kwargs["size"] = self.url_sizes[url]
                 try:
                     lgr.debug("%s: Attempting to open via URL %s", relpath, url)
-                    return self.fs.open(url, mode, **kwargs)  # type: ignore
-                except BlocksizeMismatchError as e:
-                    lgr.warning(
-                        "%s: Blocksize mismatch: %s; deleting cached file and"
-                        " re-opening",
-                        relpath,
-                        e,
-                    )
-                    self.fs.pop_from_cache(url)
-                    return self.fs.open(url, mode, **kwargs)  # type: ignore
+                    f = self.open_url(relpath, url, mode, open_kwargs)
                 except FileNotFoundError as e:
                     lgr.debug(
                         "Failed to open file %s at URL %s: %s", relpath, url, str(e)
                     )
+                    if self.good_urls.get(skey) == url:
+                        self.forget_url(skey, url)
+                    continue
+                except Exception as e:
+                    if self.good_urls.get(skey) != url:
+                        raise
+                    # The remembered URL may have expired or become
+                    # unreachable; fall back to the others
+                    lgr.debug(
+                        "Failed to open file %s at remembered URL %s: %s",
+                        relpath,
+                        url,
+                        str(e),
+                    )
+                    self.forget_url(skey, url)
+                    continue
+                self.set_good_url(skey, url)
+                if isinstance(f, HTTPFile):
+                    self.set_url_size(url, f.size)
+                    if prefetch and not self.caching:
+                        return PrefetchingFile(f, self.get_executor())  # type: ignore
+                return f  # type: ignore
             raise IOError(
                 f"Could not find a usable URL for {relpath} within {self.path}"
             )
         else:
             lgr.debug("%s: opening directly", relpath)
-            return open(self.path / relpath, mode, **kwargs)  # type: ignore
+            return open(os.path.join(self.path, relpath), mode, **kwargs)  # type: ignore
 
     def clear(self) -> None:
         if self.caching:
             self.fs.clear_cache()
+            self.good_urls.clear()
+            self.good_urls_dirty = False
+            if self.state_cache_file is not None and (
+                self.state_cache is not None or os.path.exists(self.state_cache_file)
+            ):
+                state_cache = self.get_state_cache()
+                if state_cache is not None:
+                    state_cache.clear()
+            try:
+                os.unlink(self.url_cache_file)
+            except FileNotFoundError:
+                pass
 
 
 class FsspecAdapter:
     def __init__(
-        self, root: str | Path, caching: bool, mode_transparent: bool = False
+        self,
+        root: str | Path,
+        caching: bool,
+        mode_transparent: bool = False,
+        block_size: int = BLOCK_SIZE,
+        cache_type: str = "bytes",
     ) -> None:
         self.root = Path(root)
+        # String form of `root` used when resolving paths
+        self.rootstr = os.path.normpath(self.root)
         self.mode_transparent = mode_transparent
         self.caching = caching
-        self.datasets: dict[Path, DatasetAdapter] = {}
+        self.block_size = block_size
+        self.cache_type = cache_type
+        self.datasets: dict[str, DatasetAdapter] = {}
+        # Paths of the installed (sub)datasets under `root` found so far, so
+        # that the dataset containing a path can be determined without
+        # touching the filesystem
+        self.dataset_paths: set[str] = {self.rootstr}
+        # Paths of the datasets whose subdatasets have been registered;
+        # datasets are only scanned once a path inside them is looked up
+        self.scanned_datasets: set[str] = set()
+        # Paths of subdatasets that were not installed when last scanned
+        self.absent_subdatasets: set[str] = set()
+        # Directories that were checked not to be unregistered repositories
+        self.plain_dirs: set[str] = set()
 
     def __enter__(self) -> FsspecAdapter:
         return self
@@ -223,27 +718,81 @@ class FsspecAdapter:
         _exc_val: Optional[BaseException],
         _exc_tb: Optional[TracebackType],
     ) -> None:
+        self.close()
+
+    def close(self) -> None:
         for ds in self.datasets.values():
             ds.close()
         self.datasets.clear()
 
-    @methodtools.lru_cache(maxsize=CACHE_SIZE)
-    # TODO: optimize "caching" more since for all files under the same directory
-    # they all would belong to the same dataset
-    def get_dataset_path(self, path: str | Path) -> Path:
-        path = Path(self.root, path)
-        dspath = get_dataset_root(path)
-        if dspath is None:
-            raise ValueError(f"Path not under DataLad: {path}")
-        dspath = Path(dspath)
-        assert isinstance(dspath, Path)
-        try:
-            dspath.relative_to(self.root)
-        except ValueError:
-            raise ValueError(f"Path not under root dataset: {path}")
-        return dspath
+    def scan_datasets(self, dspath: str) -> None:
+        """Register the immediate subdatasets of a dataset"""
+        lgr.debug("Scanning %s for subdatasets", dspath)
+        self.scanned_datasets.add(dspath)
+        for sub in Dataset(dspath).subdatasets(
+            recursive=False,
+            result_renderer="disabled",
+            return_type="generator",
+            on_failure="ignore",
+        ):
+            if sub.get("status") != "ok" or sub.get("type") != "dataset":
+                continue
+            if sub.get("state") == "absent":
+                self.absent_subdatasets.add(sub["path"])
+            else:
+                self.dataset_paths.add(sub["path"])
+
+    def get_dataset_path(self, path: str | Path) -> str:
+        path = os.path.normpath(os.path.join(self.rootstr, path))
+        while True:
+            p = path
+            while p not in self.dataset_paths:
+                if p in self.absent_subdatasets and os.path.exists(
+                    os.path.join(p, ".git")
+                ):
+                    lgr.debug("Subdataset %s got installed; registering", p)
+                    self.absent_subdatasets.discard(p)
+                    self.dataset_paths.add(p)
+                    break
+                parent = os.path.dirname(p)
+                if parent == p:
+                    raise ValueError(f"Path not under root dataset: {path}")
+                p = parent
+            if p == path or path[len(p) + 1 :].split(os.sep, 1)[0] == ".git":
+                return p
+            if p not in self.scanned_datasets:
+                # The path might be inside one of the dataset's subdatasets
+                self.scan_datasets(p)
+                continue
+            nested = self.find_unregistered_dataset(p, path)
+            if nested is None:
+                return p
+            lgr.debug("Found repository %s not registered as a subdataset", nested)
+            self.dataset_paths.add(nested)
+
+    def find_unregistered_dataset(self, dspath: str, path: str) -> Optional[str]:
+        """
+        Return the topmost directory below the dataset at ``dspath`` leading
+        to ``path`` (including ``path`` itself if it is a directory) that is a
+        repository of its own despite not being a registered subdataset, or
+        `None` if there is no such directory
+        """
+        d = dspath
+        for part in path[len(dspath) + 1 :].split(os.sep):
+            if part == ".git":
+                break
+            d = os.path.join(d, part)
+            if d in self.plain_dirs:
+                continue
+            # This is false if `d` is not a directory
+            if os.path.lexists(os.path.join(d, ".git")):
+                return d
+            if d != path:
+                self.plain_dirs.add(d)
+        return None
 
     def resolve_dataset(self, filepath: str | Path) -> tuple[DatasetAdapter, str]:
+        filepath = os.path.normpath(os.path.join(self.rootstr, filepath))
         dspath = self.get_dataset_path(filepath)
         try:
             dsap = self.datasets[dspath]
@@ -252,8 +801,10 @@ class FsspecAdapter:
                 dspath,
                 mode_transparent=self.mode_transparent,
                 caching=self.caching,
+                block_size=self.block_size,
+                cache_type=self.cache_type,
             )
-        relpath = str(Path(filepath).relative_to(dspath))
+        relpath = filepath[len(dspath) + 1 :] or "."
         return dsap, relpath
 
     def open(
@@ -262,12 +813,15 @@ class FsspecAdapter:
         mode: str = "rb",
         encoding: str = "utf-8",
         errors: Optional[str] = None,
+        prefetch: bool = False,
     ) -> IO:
         dsap, relpath = self.resolve_dataset(filepath)
         lgr.debug(
             "%s: path resolved to %s in dataset at %s", filepath, relpath, dsap.path
         )
-        return dsap.open(relpath, mode=mode, encoding=encoding, errors=errors)
+        return dsap.open(
+            relpath, mode=mode, encoding=encoding, errors=errors, prefetch=prefetch
+        )
 
     def get_file_state(
         self, filepath: str | Path
@@ -275,6 +829,10 @@ class FsspecAdapter:
         dsap, relpath = self.resolve_dataset(filepath)
         return cast(Tuple[FileState, Optional[AnnexKey]], dsap.get_file_state(relpath))
 
+    def prime_dir(self, dirpath: str | Path) -> None:
+        dsap, reldir = self.resolve_dataset(dirpath)
+        dsap.prime_dir(reldir)
+
     def is_under_annex(self, filepath: str | Path) -> bool:
         dsap, relpath = self.resolve_dataset(filepath)
         fstate, _ = dsap.get_file_state(relpath)
@@ -285,8 +843,184 @@ class FsspecAdapter:
         return dsap.commit_dt
 
 
+class PrefetchingFile:
+    """
+    Wrapper around an `HTTPFile` which, as long as reads are sequential,
+    fetches the blocks following the current position in background threads.
+    These blocks are independent of (and normally larger than) those of the
+    `HTTPFile`, which serves all other reads.
+    The number of blocks fetched ahead doubles with each sequential read up to
+    `PREFETCH_BLOCKS`; a read anywhere else drops the prefetched blocks and
+    starts over.
+
+    Only the subset of the file API used by `DataLadFUSE` is provided.
+    """
+
+    def __init__(
+        self,
+        f: HTTPFile,
+        executor: ThreadPoolExecutor,
+        max_ahead: int = PREFETCH_BLOCKS,
+        blocksize: int = PREFETCH_BLOCK_SIZE,
+    ) -> None:
+        self.f = f
+        self.executor = executor
+        self.max_ahead = max_ahead
+        self.blocksize = blocksize
+        self.size: int = f.size
+        self.loc = 0
+        # Offset just past the end of the previous read
+        self.last_end: Optional[int] = None
+        self.ahead = 0
+        self.blocks: dict[int, Future[bytes]] = {}
+
+    @property
+    def closed(self) -> bool:
+        return bool(self.f.closed)
+
+    def info(self) -> dict[str, Any]:
+        info = self.f.info()
+        assert isinstance(info, dict)
+        return info
+
+    def tell(self) -> int:
+        return self.loc
+
+    def seek(self, loc: int, whence: int = 0) -> int:
+        if whence == 0:
+            self.loc = loc
+        elif whence == 1:
+            self.loc += loc
+        elif whence == 2:
+            self.loc = self.size + loc
+        else:
+            raise ValueError(f"Invalid whence: {whence!r}")
+        return self.loc
+
+    def read(self, length: int = -1) -> bytes:
+        start = self.loc
+        end = self.size if length < 0 else min(start + length, self.size)
+        if start >= end:
+            return b""
+        if start == self.last_end:
+            self.ahead = min(max(2 * self.ahead, 1), self.max_ahead)
+        else:
+            self.ahead = 0
+            self.drop_blocks()
+        data = self.read_blocks(start, end) if self.ahead else None
+        if data is None:
+            self.f.seek(start)
+            data = self.f.read(end - start)
+        self.loc = self.last_end = start + len(data)
+        return data
+
+    def read_blocks(self, start: int, end: int) -> Optional[bytes]:
+        """
+        Return the data from ``start`` to ``end`` if it is covered by
+        prefetched blocks (else `None`), and schedule fetching of the blocks
+        that follow
+        """
+        first = start // self.blocksize
+        last = (end - 1) // self.blocksize
+        for i in [i for i in self.blocks if i < first]:
+            self.blocks.pop(i).cancel()
+        nblocks = -(-self.size // self.blocksize)
+        for i in range(last + 1, min(last + self.ahead + 1, nblocks)):
+            if i not in self.blocks:
+                self.blocks[i] = self.executor.submit(self.fetch_block, i)
+        if not all(i in self.blocks for i in range(first, last + 1)):
+            return None
+        for i in range(first, last + 1):
+            if self.blocks[i].cancel():
+                # Still queued behind other downloads, so rather than waiting,
+                # read directly
+                del self.blocks[i]
+                return None
+        try:
+            data = b"".join(self.blocks[i].result() for i in range(first, last + 1))
+        except Exception as e:
+            lgr.debug(
+                "Prefetching from %s failed: %s; disabling prefetching", self.f.url, e
+            )
+            self.max_ahead = self.ahead = 0
+            self.drop_blocks()
+            return None
+        offset = first * self.blocksize
+        return data[start - offset : end - offset]
+
+    def fetch_block(self, i: int) -> bytes:
+        start = i * self.blocksize
+        end = min(start + self.blocksize, self.size)
+        data = self.f._fetch_range(start, end)
+        if len(data) != end - start:
+            raise ValueError(f"Got {len(data)} bytes instead of {end - start}")
+        assert isinstance(data, bytes)
+        return data
+
+    def drop_blocks(self) -> None:
+        for fut in self.blocks.values():
+            fut.cancel()
+        self.blocks.clear()
+
+    def close(self) -> None:
+        self.drop_blocks()
+        self.f.close()
+
+
+def annex_path_state(p: str) -> tuple[FileState, Optional[AnnexKey]]:
+    """Determine the state of a file given its path under .git/annex/objects"""
+    iadok = is_annex_dir_or_key(p)
+    if isinstance(iadok, AnnexKey):
+        if os.path.exists(p):
+            return (FileState.HAS_CONTENT, iadok)
+        else:
+            return (FileState.NO_CONTENT, iadok)
+    else:
+        return (FileState.NOT_ANNEXED, None)
+
+
+def is_pointer_file(p: str) -> bool:
+    """Tell whether the file at ``p`` starts like a git-annex pointer file"""
+    with open(p, "rb") as fp:
+        return fp.read(len(POINTER_PREFIX)) == POINTER_PREFIX
+
+
+def load_url_cache(path: str) -> dict[str, str]:
+    try:
+        with open(path) as fp:
+            data = json.load(fp)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        lgr.warning("Ignoring corrupted URL cache %s: %s", path, e)
+        return {}
+    assert isinstance(data, dict)
+    trim_dict(data, URL_CACHE_SIZE)
+    return data
+
+
+def save_url_cache(path: str, good_urls: dict[str, str]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so that an interrupted write does not
+    # leave a truncated cache behind
+    tmppath = f"{path}.{os.getpid()}.tmp"
+    with open(tmppath, "w") as fp:
+        json.dump(good_urls, fp)
+    os.replace(tmppath, path)
+
+
+def trim_dict(d: dict, maxsize: int) -> None:
+    """Remove the oldest entries of ``d`` until it has at most ``maxsize``"""
+    while len(d) > maxsize:
+        del d[next(iter(d))]
+
+
 def is_http_url(s: str) -> bool:
-    return s.lower().startswith(("http://", "https://"))
+    # Schemes are nearly always lowercase, so only lowercase the start of the
+    # URL when that check fails
+    return s.startswith(("http://", "https://")) or s[:8].lower().startswith(
+        ("http://", "https://")
+    )
 
 
 async def on_request_start(
@@ -301,6 +1035,12 @@ async def on_request_start(
 async def get_client(**kwargs: Any) -> RetryClient:
     trace_config = aiohttp.TraceConfig()
     trace_config.on_request_start.append(on_request_start)
+    kwargs.setdefault(
+        "connector",
+        aiohttp.TCPConnector(
+            keepalive_timeout=KEEPALIVE_TIMEOUT, ttl_dns_cache=DNS_CACHE_TTL
+        ),
+    )
     return RetryClient(
         client_session=aiohttp.ClientSession(
             trace_configs=[trace_config],
@@ -44,13 +44,15 @@ class FsspecCacheClear(Interface):
         ds = require_dataset(
             dataset, purpose="clear fsspec cache", check_installed=True
         )
-        DatasetAdapter(ds.path, caching=True).clear()
+        with DatasetAdapter(ds.path, caching=True) as dsap:
+            dsap.clear()
         yield get_status_dict(action="fsspec-cache-clear", ds=ds, status="ok")
         if recursive:
             for subds in ds.subdatasets(
-                recursive=True, fulfilled=True, result_renderer="disabled"
+                recursive=True, state="present", result_renderer="disabled"
             ):
-                DatasetAdapter(subds["path"], caching=True).clear()
+                with DatasetAdapter(subds["path"], caching=True) as dsap:
+                    dsap.clear()
                 yield get_status_dict(
                     action="fsspec-cache-clear",
                     refds=ds.path,
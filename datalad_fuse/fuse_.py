@@ -10,7 +10,6 @@ import io
 import logging
 import os
 import os.path as op
-from pathlib import Path
 import stat
 import sys
 from threading import Lock
@@ -21,12 +20,8 @@ from datalad.distribution.dataset import Dataset
 from fuse import FuseOSError, Operations
 import methodtools
 
-from .consts import CACHE_SIZE
+from .consts import BLOCK_SIZE, CACHE_SIZE
 from .fsspec import FsspecAdapter
-
-# Make it relatively small since we are aiming for metadata records ATM
-# Seems of no real good positive net ATM
-# BLOCK_SIZE = 2**20  # 1M. block size to fetch at a time.
 from .utils import AnnexDir, AnnexKey, is_annex_dir_or_key
 
 if sys.version_info[:2] >= (3, 10):
@@ -88,7 +83,7 @@ class DataLadFUSE(Operations):  # LoggingMixIn,
         lgr.debug("op=%s for path=%s with args %s", op, path, args)
         # if (".git", "annex", "objects") == Path(path).parts[-7:-4]:
         #     import pdb; pdb.set_trace()
-        if not self.mode_transparent and ".git" in Path(path).parts:
+        if not self.mode_transparent and ".git" in path.split("/"):
             lgr.debug("Raising ENOENT for .git")
             raise FuseOSError(ENOENT)
         return super(DataLadFUSE, self).__call__(op, self.root + path, *args)
@@ -106,7 +101,10 @@ class DataLadFUSE(Operations):  # LoggingMixIn,
         if cache_clear == "visited":
             for dsap in self._adapter.datasets.values():
                 dsap.clear()
-        elif cache_clear == "recursive":
+        # Closing saves the remembered URLs, so it must precede a recursive
+        # clear for the latter to remove them
+        self._adapter.close()
+        if cache_clear == "recursive":
             Dataset(self.root).fsspec_cache_clear(recursive=True)
         return 0
 
@@ -232,7 +230,7 @@ class DataLadFUSE(Operations):  # LoggingMixIn,
                 # write/create
                 raise FuseOSError(EROFS)
             with self.rwlock:
-                fsspec_file = self._adapter.open(path)
+                fsspec_file = self._adapter.open(path, prefetch=True)
             lgr.debug("Counter = %d", self._counter)
             # TODO: threadlock ?
             self._fhdict[self._counter] = fsspec_file  # self.fs.open(fn, mode)
@@ -399,7 +397,11 @@ class DataLadFUSE(Operations):  # LoggingMixIn,
         return r
 
     def is_under_git(self, path: str) -> bool:
-        return ".git" in Path(path).relative_to(self.root).parts
+        if path == self.root:
+            return False
+        elif not path.startswith(self.root + os.sep):
+            raise ValueError(f"Path not under root: {path}")
+        return ".git" in path[len(self.root) + 1 :].split(os.sep)
 
 
 def file_getattr(f: Any, timestamp: datetime) -> dict[str, Any]:
@@ -423,7 +425,7 @@ def mkstat(is_file: bool, size: int, timestamp: datetime) -> dict[str, Any]:
     else:
         data["st_mode"] = stat.S_IFREG | 0o644
         data["st_size"] = size
-        data["st_blksize"] = 5 * 2**20
+        data["st_blksize"] = BLOCK_SIZE
         data["st_nlink"] = 1
     data["st_atime"] = timestamp.timestamp()
     data["st_ctime"] = timestamp.timestamp()
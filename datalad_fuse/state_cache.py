@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+from threading import Lock
+import time
+from typing import Optional
+
+from .consts import STATE_CACHE_SIZE
+
+lgr = logging.getLogger("datalad.fuse.state_cache")
+
+# How many insertions to make between checks for whether to evict entries
+EVICT_INTERVAL = 1000
+
+# Version of the database layout; caches with a different version are
+# discarded
+SCHEMA_VERSION = 1
+
+
+class StateCache:
+    """
+    Persistent record of what git-annex had to say about files in a dataset,
+    keyed by path and invalidated whenever a file's mtime or size changes.
+
+    Entries map to the subset of ``git annex find --json`` output that
+    `DatasetAdapter` needs; an empty dict means the file is not annexed.
+    Once there are more than ``max_entries`` entries, the least recently
+    accessed ones are evicted.
+    """
+
+    def __init__(self, path: str, max_entries: int = STATE_CACHE_SIZE) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.inserts = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        (version,) = self.db.execute("PRAGMA user_version").fetchone()
+        if version != SCHEMA_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS annexinfo")
+            self.db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS annexinfo ("
+            " relpath TEXT PRIMARY KEY,"
+            " mtime_ns INTEGER NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " key TEXT,"
+            " hashdirmixed TEXT,"
+            " hashdirlower TEXT,"
+            " last_access INTEGER NOT NULL"
+            ")"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS annexinfo_last_access"
+            " ON annexinfo (last_access)"
+        )
+
+    def get(self, relpath: str, st: os.stat_result) -> Optional[dict[str, str]]:
+        """Return the cached info for a file, or `None` if there is none"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT key, hashdirmixed, hashdirlower FROM annexinfo"
+                " WHERE relpath = ? AND mtime_ns = ? AND size = ?",
+                (relpath, st.st_mtime_ns, st.st_size),
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE annexinfo SET last_access = ? WHERE relpath = ?",
+                (int(time.time()), relpath),
+            )
+        key, hashdirmixed, hashdirlower = row
+        if key is None:
+            return {}
+        return {"key": key, "hashdirmixed": hashdirmixed, "hashdirlower": hashdirlower}
+
+    def set(self, relpath: str, st: os.stat_result, info: dict[str, str]) -> None:
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO annexinfo"
+                " (relpath, mtime_ns, size, key, hashdirmixed, hashdirlower,"
+                " last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    relpath,
+                    st.st_mtime_ns,
+                    st.st_size,
+                    info.get("key"),
+                    info.get("hashdirmixed"),
+                    info.get("hashdirlower"),
+                    int(time.time()),
+                ),
+            )
+            self.inserts += 1
+            if self.inserts % EVICT_INTERVAL == 0:
+                self.evict()
+
+    def evict(self) -> None:
+        (count,) = self.db.execute("SELECT COUNT(*) FROM annexinfo").fetchone()
+        if count > self.max_entries:
+            lgr.debug(
+                "Evicting %d entries from %s", count - self.max_entries, self.path
+            )
+            self.db.execute(
+                "DELETE FROM annexinfo WHERE relpath IN ("
+                " SELECT relpath FROM annexinfo"
+                " ORDER BY last_access LIMIT ?"
+                ")",
+                (count - self.max_entries,),
+            )
+
+    def clear(self) -> None:
+        with self.lock:
+            self.db.execute("DELETE FROM annexinfo")
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,401 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import subprocess
+from threading import Event
+from typing import Any
+
+import aiohttp
+from datalad.api import Dataset, clone
+import pytest
+
+from datalad_fuse.consts import DNS_CACHE_TTL, KEEPALIVE_TIMEOUT
+from datalad_fuse.fsspec import (
+    FileState,
+    FsspecAdapter,
+    PrefetchingFile,
+    get_client,
+    is_http_url,
+)
+
+
+class FakeHTTPFile:
+    """Stand-in for an `HTTPFile` that records the ranges fetched from it"""
+
+    url = "http://example.nil/blob"
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.size = len(data)
+        self.loc = 0
+        self.closed = False
+        self.fetched: list[tuple[int, int]] = []
+
+    def seek(self, loc: int) -> None:
+        self.loc = loc
+
+    def read(self, length: int) -> bytes:
+        data = self._fetch_range(self.loc, self.loc + length)
+        self.loc += len(data)
+        return data
+
+    def _fetch_range(self, start: int, end: int) -> bytes:
+        self.fetched.append((start, end))
+        return self.data[start:end]
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_reopen_skips_size_request(url_dataset, monkeypatch):
+    ds, data_files = url_dataset
+    if Path(ds.path, "binary.png").exists():
+        pytest.skip("Content is present locally; no URL is needed")
+    with FsspecAdapter(ds.path, caching=False) as fsa:
+        path = Path(ds.path, "binary.png")
+        with fsa.open(path) as fp:
+            assert fp.read() == data_files["binary.png"]
+        dsap, _ = fsa.resolve_dataset(path)
+
+        def info(*_args, **_kwargs):
+            raise AssertionError("Size should not be requested again")
+
+        monkeypatch.setattr(dsap.fs, "info", info)
+        with fsa.open(path) as fp:
+            assert fp.read() == data_files["binary.png"]
+
+
+def test_stale_good_url_forgotten(url_dataset, monkeypatch):
+    ds, data_files = url_dataset
+    if Path(ds.path, "binary.png").exists():
+        pytest.skip("Content is present locally; no URL is needed")
+    with FsspecAdapter(ds.path, caching=False) as fsa:
+        path = Path(ds.path, "binary.png")
+        dsap, relpath = fsa.resolve_dataset(path)
+        _, key = dsap.get_file_state(relpath)
+        stale = "http://example.nil/expired/binary.png"
+        dsap.set_good_url(str(key), stale)
+        dsap.good_urls_dirty = False
+        real_open = dsap.fs.open
+
+        def fs_open(url, *args, **kwargs):
+            if url == stale:
+                # As for, e.g., an expired signed URL
+                raise PermissionError("403 Forbidden")
+            return real_open(url, *args, **kwargs)
+
+        monkeypatch.setattr(dsap.fs, "open", fs_open)
+        with fsa.open(path) as fp:
+            assert fp.read() == data_files["binary.png"]
+        assert dsap.good_urls[str(key)] != stale
+        assert dsap.good_urls_dirty
+
+
+@pytest.mark.parametrize("chunk", [7, 10, 25])
+def test_prefetching_file_sequential(chunk):
+    data = bytes(range(256)) * 4
+    f = FakeHTTPFile(data)
+    with ThreadPoolExecutor() as executor:
+        pf = PrefetchingFile(f, executor, blocksize=100)
+        out = b""
+        while True:
+            pf.seek(len(out))
+            blob = pf.read(chunk)
+            if not blob:
+                break
+            out += blob
+        pf.close()
+    assert out == data
+    assert f.closed
+    # Everything past the first couple of reads should come from whole
+    # prefetched blocks
+    assert (900, 1000) in f.fetched
+    assert (1000, 1024) in f.fetched
+
+
+def test_prefetching_file_seek_resets():
+    data = bytes(range(256)) * 4
+    f = FakeHTTPFile(data)
+    with ThreadPoolExecutor() as executor:
+        pf = PrefetchingFile(f, executor, blocksize=100)
+        assert pf.read(10) == data[:10]
+        assert pf.read(10) == data[10:20]
+        assert pf.blocks
+        pf.seek(500)
+        assert pf.read(10) == data[500:510]
+        assert pf.ahead == 0
+        assert not pf.blocks
+        assert pf.read(-1) == data[510:]
+        pf.close()
+
+
+def test_prefetching_file_busy_executor():
+    data = bytes(range(256)) * 4
+    f = FakeHTTPFile(data)
+    release = Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Occupy the only worker, as another file's downloads would
+        executor.submit(release.wait)
+        pf = PrefetchingFile(f, executor, blocksize=100)
+        out = b""
+        while len(out) < 300:
+            out += pf.read(50)
+        # Reads did not wait for the queued prefetches
+        assert out == data[:300]
+        release.set()
+        pf.close()
+
+
+@pytest.mark.usefixtures("tmp_home")
+def test_get_dataset_path_subdataset_installed_later(tmp_path):
+    ds = Dataset(tmp_path / "super").create()
+    ds.create("sub")
+    clone_ds = clone(ds.path, tmp_path / "clone")
+    clone_path = Path(clone_ds.path)
+    with FsspecAdapter(clone_path, caching=False) as fsa:
+        assert fsa.get_dataset_path(clone_path / "sub" / "file.txt") == str(clone_path)
+        clone_ds.get("sub", get_data=False)
+        assert fsa.get_dataset_path(clone_path / "sub" / "file.txt") == str(
+            clone_path / "sub"
+        )
+        assert fsa.get_dataset_path(clone_path / ".git" / "config") == str(clone_path)
+        with pytest.raises(ValueError):
+            fsa.get_dataset_path(tmp_path / "super" / "file.txt")
+
+
+@pytest.mark.usefixtures("tmp_home")
+def test_get_dataset_path_scans_lazily(tmp_path):
+    ds = Dataset(tmp_path).create()
+    ds.create("sub")
+    ds.create(Path("sub", "subsub"))
+    ds.save(recursive=True)
+    with FsspecAdapter(tmp_path, caching=False) as fsa:
+        assert fsa.scanned_datasets == set()
+        assert fsa.get_dataset_path(tmp_path) == str(tmp_path)
+        assert fsa.get_dataset_path(tmp_path / ".git" / "config") == str(tmp_path)
+        assert fsa.scanned_datasets == set()
+        assert fsa.get_dataset_path(tmp_path / "sub" / "file.txt") == str(
+            tmp_path / "sub"
+        )
+        assert fsa.scanned_datasets == {str(tmp_path), str(tmp_path / "sub")}
+        subsub = str(tmp_path / "sub" / "subsub")
+        assert fsa.get_dataset_path(subsub) == subsub
+        assert subsub not in fsa.scanned_datasets
+        assert fsa.get_dataset_path(os.path.join(subsub, "file.txt")) == subsub
+        assert subsub in fsa.scanned_datasets
+
+
+@pytest.mark.usefixtures("tmp_home")
+def test_get_dataset_path_unregistered_nested(tmp_path):
+    ds = Dataset(tmp_path).create()
+    (tmp_path / "dir").mkdir()
+    Dataset(tmp_path / "dir" / "nested").create()
+    nested = str(tmp_path / "dir" / "nested")
+    with FsspecAdapter(tmp_path, caching=False) as fsa:
+        assert fsa.get_dataset_path(tmp_path / "dir" / "file.txt") == ds.path
+        assert fsa.get_dataset_path(tmp_path / "dir" / "nested") == nested
+        assert fsa.get_dataset_path(Path(nested, "f.dat")) == nested
+        assert fsa.get_dataset_path(Path(nested, ".git", "config")) == nested
+
+
+def test_prime_dir(url_dataset):
+    ds, data_files = url_dataset
+    with FsspecAdapter(ds.path, caching=False) as fsa:
+        expected = {
+            fname: fsa.get_file_state(Path(ds.path, fname)) for fname in data_files
+        }
+    with FsspecAdapter(ds.path, caching=False) as fsa:
+        fsa.prime_dir(ds.path)
+        dsap, _ = fsa.resolve_dataset(ds.path)
+        assert set(dsap.primed_states) == {
+            fname
+            for fname, (fstate, _) in expected.items()
+            if fstate is FileState.NO_CONTENT
+        }
+        for fname, state in expected.items():
+            assert fsa.get_file_state(Path(ds.path, fname)) == state
+            assert fname not in dsap.primed_states
+
+
+@pytest.mark.usefixtures("tmp_home")
+def test_probe_urls(served_files, tmp_path):
+    Dataset(tmp_path).create()
+    url = served_files[0].url
+    bad_url = url + ".missing"
+    other_url = served_files[1].url
+    with FsspecAdapter(tmp_path, caching=False) as fsa:
+        dsap, _ = fsa.resolve_dataset(tmp_path)
+        assert list(dsap.probe_urls([bad_url, url, other_url])) == [url, other_url]
+        assert list(dsap.probe_urls([bad_url])) == [bad_url]
+
+
+@pytest.mark.usefixtures("tmp_home")
+def test_get_file_state_unlocked_hint(tmp_path, monkeypatch):
+    ds = Dataset(tmp_path).create()
+    (tmp_path / "README.txt").write_text("Not annexed\n")
+    ds.save(to_git=True)
+    ds.repo.config.set("annex.addunlocked", "true", scope="local")
+    ds.repo.add_url_to_file(
+        "unlocked.dat", "http://127.0.0.1:1/unlocked.dat", options=["--relaxed"]
+    )
+    ds.save()
+    ds.repo.config.unset("annex.addunlocked", scope="local")
+    assert not (tmp_path / "unlocked.dat").is_symlink()
+    with FsspecAdapter(tmp_path, caching=False) as fsa:
+        dsap, _ = fsa.resolve_dataset(tmp_path)
+        assert not dsap.expect_unlocked
+        annex_find = dsap.annex_find
+        queried = []
+
+        def spy(relpaths):
+            queried.extend(relpaths)
+            return annex_find(relpaths)
+
+        monkeypatch.setattr(dsap, "annex_find", spy)
+        assert fsa.get_file_state(tmp_path / "README.txt") == (
+            FileState.NOT_ANNEXED,
+            None,
+        )
+        state, key = fsa.get_file_state(tmp_path / "unlocked.dat")
+        assert state is FileState.NO_CONTENT
+        assert key is not None
+        assert queried == ["unlocked.dat"]
+
+
+@pytest.mark.usefixtures("tmp_home")
+def test_http_client_reused(tmp_path, monkeypatch):
+    connector_kwargs = []
+
+    class RecordingConnector(aiohttp.TCPConnector):
+        def __init__(self, **kwargs: Any) -> None:
+            connector_kwargs.append(kwargs)
+            super().__init__(**kwargs)
+
+    monkeypatch.setattr(aiohttp, "TCPConnector", RecordingConnector)
+
+    async def make_client() -> None:
+        client = await get_client()
+        try:
+            assert isinstance(client._client.connector, RecordingConnector)
+        finally:
+            await client.close()
+
+    asyncio.run(make_client())
+    assert connector_kwargs == [
+        {"keepalive_timeout": KEEPALIVE_TIMEOUT, "ttl_dns_cache": DNS_CACHE_TTL}
+    ]
+    # All datasets go through the same HTTP filesystem and thus the same
+    # connection pool
+    ds = Dataset(tmp_path).create()
+    ds.create("sub")
+    with FsspecAdapter(tmp_path, caching=False) as fsa:
+        dsap, _ = fsa.resolve_dataset(tmp_path)
+        subap, _ = fsa.resolve_dataset(tmp_path / "sub")
+        assert dsap is not subap
+        assert dsap.fs is subap.fs
+
+
+@pytest.mark.parametrize(
+    "url,expected",
+    [
+        ("http://example.com/file", True),
+        ("https://example.com/file", True),
+        ("HTTPS://example.com/file", True),
+        ("Http://example.com/file", True),
+        ("s3://bucket/file", False),
+        ("ssh://example.com/repo", False),
+        ("/local/path", False),
+        ("http:", False),
+    ],
+)
+def test_is_http_url(url, expected):
+    assert is_http_url(url) is expected
+
+
+@pytest.mark.usefixtures("tmp_home")
+def test_present_keys(tmp_path, monkeypatch):
+    ds = Dataset(tmp_path).create()
+    (tmp_path / "present.txt").write_text("Content\n")
+    (tmp_path / "dropped.txt").write_text("Other content\n")
+    ds.save()
+    ds.drop("dropped.txt", reckless="kill")
+    # A leftover key directory without an object file does not count
+    os.makedirs(os.path.dirname(os.path.realpath(tmp_path / "dropped.txt")))
+    monkeypatch.setattr("datalad_fuse.fsspec.PRESENT_KEYS_MIN_LOOKUPS", 2)
+    with FsspecAdapter(tmp_path, caching=False) as fsa:
+        dsap, _ = fsa.resolve_dataset(tmp_path)
+        state, key = dsap.symlink_state(str(tmp_path / "present.txt"))
+        assert state is FileState.HAS_CONTENT
+        assert dsap.present_keys_scan is None
+        assert dsap.symlink_state(str(tmp_path / "present.txt")) == (
+            FileState.HAS_CONTENT,
+            key,
+        )
+        scan = dsap.present_keys_scan
+        if scan is not None:
+            assert scan.daemon
+            scan.join()
+        assert dsap.present_keys == {
+            os.path.basename(os.readlink(tmp_path / "present.txt"))
+        }
+        assert dsap.symlink_state(str(tmp_path / "present.txt")) == (
+            FileState.HAS_CONTENT,
+            key,
+        )
+        state, _ = dsap.symlink_state(str(tmp_path / "dropped.txt"))
+        assert state is FileState.NO_CONTENT
+        # Dropping content changes git-annex's state, upon which the scan is
+        # no longer relied on
+        ds.drop("present.txt", reckless="kill")
+        dsap.present_keys_checked = 0.0
+        state, _ = dsap.symlink_state(str(tmp_path / "present.txt"))
+        assert state is FileState.NO_CONTENT
+        assert dsap.present_keys is None
+
+
+@pytest.mark.usefixtures("tmp_home")
+@pytest.mark.parametrize("objecthashlower", [False, True])
+def test_get_file_state_unlocked_escaped_key(tmp_path, objecthashlower):
+    subprocess.run(["git", "init", "-q"], cwd=tmp_path, check=True)
+    subprocess.run(
+        [
+            "git",
+            "-c",
+            f"annex.tune.objecthashlower={str(objecthashlower).lower()}",
+            "annex",
+            "init",
+            "-q",
+        ],
+        cwd=tmp_path,
+        check=True,
+    )
+    ds = Dataset(tmp_path)
+    (tmp_path / "a:b&c%d.txt").write_text("Content\n")
+    ds.repo.config.set("annex.addunlocked", "true", scope="local")
+    ds.repo.call_annex(["add", "--backend=WORM", "a:b&c%d.txt"])
+    ds.save()
+    assert not (tmp_path / "a:b&c%d.txt").is_symlink()
+    assert ds.repo.file_has_content("a:b&c%d.txt")
+    with FsspecAdapter(tmp_path, caching=False) as fsa:
+        state, key = fsa.get_file_state(tmp_path / "a:b&c%d.txt")
+        assert state is FileState.HAS_CONTENT
+        assert key is not None
+        with fsa.open(tmp_path / "a:b&c%d.txt", "rt") as fp:
+            assert fp.read() == "Content\n"
+
+
+@pytest.mark.usefixtures("tmp_home")
+def test_url_caches_bounded(tmp_path, monkeypatch):
+    Dataset(tmp_path).create()
+    monkeypatch.setattr("datalad_fuse.fsspec.URL_CACHE_SIZE", 3)
+    with FsspecAdapter(tmp_path, caching=False) as fsa:
+        dsap, _ = fsa.resolve_dataset(tmp_path)
+        for i in range(5):
+            dsap.set_good_url(f"key{i}", f"http://example.nil/{i}")
+            dsap.set_url_size(f"http://example.nil/{i}", i)
+        # Using a key again keeps it around
+        dsap.set_good_url("key2", "http://example.nil/2")
+        dsap.set_good_url("key5", "http://example.nil/5")
+        assert list(dsap.good_urls) == ["key4", "key2", "key5"]
+        assert list(dsap.url_sizes) == [f"http://example.nil/{i}" for i in (2, 3, 4)]
@@ -1,4 +1,6 @@
+import json
 from pathlib import Path
+import re
 import subprocess
 
 from datalad.api import Dataset
@@ -6,6 +8,8 @@ from datalad.tests.utils_pytest import assert_in_results
 from linesep import split_terminated
 import pytest
 
+from datalad_fuse.fsspec import DatasetAdapter
+
 
 def first_n_lines(blob, n):
     # In order to match the behavior of Python's binary IO files, only \n
@@ -140,3 +144,67 @@ def test_git_repo(tmp_path):
         status="ok",
         data=first_n_lines(TEXT, 10),
     )
+
+
+@pytest.mark.usefixtures("tmp_home")
+@pytest.mark.parametrize("caching", ["none", "ondisk"])
+def test_unlocked_get_bytes_binary(served_files, tmp_path, caching, monkeypatch):
+    ds = Dataset(tmp_path).create()
+    ds.repo.config.set("annex.addunlocked", "true", scope="local")
+    for dfile in served_files:
+        ds.repo.add_url_to_file(dfile.path, dfile.url, options=["--relaxed"])
+    ds.save(message="Add unlocked files")
+    assert not (tmp_path / "binary.png").is_symlink()
+    data_files = {df.path: df.content for df in served_files}
+    annex_find = DatasetAdapter.annex_find
+    queried = []
+
+    def spy(self, relpaths):
+        queried.extend(relpaths)
+        return annex_find(self, relpaths)
+
+    monkeypatch.setattr(DatasetAdapter, "annex_find", spy)
+    for _ in range(2):
+        assert_in_results(
+            ds.fsspec_head("binary.png", bytes=100, caching=caching),
+            action="fsspec-head",
+            type="dataset",
+            status="ok",
+            data=data_files["binary.png"][:100],
+        )
+    # Second time around, the file state comes from the on-disk cache if
+    # enabled
+    if caching == "ondisk":
+        assert queried == ["binary.png"]
+    else:
+        assert queried == ["binary.png", "binary.png"]
+
+
+def test_url_cache_persisted(url_dataset):
+    ds, data_files = url_dataset
+    if Path(ds.path, "text.txt").exists():
+        pytest.skip("Content is present locally; no URL is needed")
+    cache_file = Path(ds.path, ".git", "datalad", "cache", "fsspec-urls.json")
+    assert_in_results(
+        ds.fsspec_head("text.txt", bytes=100, caching="ondisk"),
+        action="fsspec-head",
+        type="dataset",
+        status="ok",
+        data=data_files["text.txt"][:100],
+    )
+    good_urls = json.loads(cache_file.read_text())
+    assert len(good_urls) == 1
+    # The deliberately broken URL must not have been remembered
+    assert not re.search(r":\d+/0", next(iter(good_urls.values())))
+    # Reopening via the remembered URL still works after a "remount"
+    assert_in_results(
+        ds.fsspec_head("text.txt", bytes=100, caching="ondisk"),
+        action="fsspec-head",
+        type="dataset",
+        status="ok",
+        data=data_files["text.txt"][:100],
+    )
+    ds.fsspec_cache_clear()
+    assert not cache_file.exists()
+    # Only unlocked files need the file state cache, so it is not created
+    assert not (cache_file.parent / "state.sqlite").exists()
@@ -6,6 +6,7 @@ from pathlib import Path
 import subprocess
 from typing import Iterator, Union
 
+from datalad import cfg
 from datalad.api import Dataset
 import pytest
 
@@ -96,6 +97,24 @@ def test_fuse_subdataset(tmp_path, superdataset, cache_clear, transparent, tmp_h
         assert list(cachedir.iterdir()) != []
 
 
+def test_destroy_cache_clear_recursive(url_dataset):
+    # Imported here since importing `fuse` fails without libfuse
+    from datalad_fuse.fuse_ import DataLadFUSE
+
+    ds, data_files = url_dataset
+    if (ds.pathobj / "text.txt").exists():
+        pytest.skip("Content is present locally; no URL is needed")
+    fuse = DataLadFUSE(ds.path, caching=True)
+    with fuse._adapter.open(ds.pathobj / "text.txt") as fp:
+        assert fp.read() == data_files["text.txt"]
+    cfg.set("datalad.fusefs.cache-clear", "recursive", scope="override")
+    try:
+        fuse.destroy()
+    finally:
+        cfg.unset("datalad.fusefs.cache-clear", scope="override")
+    assert not (ds.pathobj / ".git" / "datalad" / "cache" / "fsspec-urls.json").exists()
+
+
 def test_fuse_transparent_hash_object(tmp_path):
     ds = Dataset(tmp_path / "ds").create()
     with fusing(ds.path, tmp_path / "mount", transparent=True) as mount:
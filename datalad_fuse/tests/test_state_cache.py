@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+import sqlite3
+
+from datalad_fuse.state_cache import EVICT_INTERVAL, StateCache
+
+INFO = {
+    "key": "MD5E-s5--0a4d55a8d778e5022fab701977c5d840.txt",
+    "hashdirmixed": "Xj/1G/",
+    "hashdirlower": "f5a/e3a/",
+}
+
+
+def test_state_cache(tmp_path: Path) -> None:
+    f = tmp_path / "file.txt"
+    f.write_text("hello")
+    g = tmp_path / "other.txt"
+    g.write_text("world")
+    cache = StateCache(str(tmp_path / "cache" / "state.sqlite"))
+    try:
+        assert cache.get("file.txt", os.lstat(f)) is None
+        cache.set("file.txt", os.lstat(f), INFO)
+        cache.set("other.txt", os.lstat(g), {})
+        assert cache.get("file.txt", os.lstat(f)) == INFO
+        assert cache.get("other.txt", os.lstat(g)) == {}
+        f.write_text("hello, world")
+        assert cache.get("file.txt", os.lstat(f)) is None
+    finally:
+        cache.close()
+    cache = StateCache(str(tmp_path / "cache" / "state.sqlite"))
+    try:
+        assert cache.get("other.txt", os.lstat(g)) == {}
+        cache.clear()
+        assert cache.get("other.txt", os.lstat(g)) is None
+    finally:
+        cache.close()
+
+
+def test_state_cache_evict(tmp_path: Path) -> None:
+    f = tmp_path / "file.txt"
+    f.write_text("hello")
+    st = os.lstat(f)
+    cache = StateCache(str(tmp_path / "state.sqlite"), max_entries=10)
+    try:
+        for i in range(EVICT_INTERVAL):
+            cache.set(f"file{i}.txt", st, INFO)
+        (count,) = cache.db.execute("SELECT COUNT(*) FROM annexinfo").fetchone()
+        assert count == 10
+    finally:
+        cache.close()
+
+
+def test_state_cache_old_schema(tmp_path: Path) -> None:
+    f = tmp_path / "file.txt"
+    f.write_text("hello")
+    path = str(tmp_path / "state.sqlite")
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE annexinfo (relpath TEXT PRIMARY KEY, mtime_ns INTEGER,"
+        " size INTEGER, key TEXT, hashdirmixed TEXT, last_access INTEGER)"
+    )
+    db.commit()
+    db.close()
+    cache = StateCache(path)
+    try:
+        cache.set("file.txt", os.lstat(f), INFO)
+        assert cache.get("file.txt", os.lstat(f)) == INFO
+    finally:
+        cache.close()
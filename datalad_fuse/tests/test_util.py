@@ -62,3 +62,8 @@ URL_ANNEX_KEY = AnnexKey(backend="URL", name="http://127.0.0.1:55485/binary.png"
 )
 def test_is_annex_dir_or_key(path: str, expected: AnnexDir | AnnexKey | None) -> None:
     assert is_annex_dir_or_key(path) == expected
+
+
+@pytest.mark.parametrize("filename", [SAMPLE_KEY, URL_KEY, "WORM-s2-m1--a&cb&a&s.txt"])
+def test_key_to_filename(filename: str) -> None:
+    assert AnnexKey.parse_filename(filename).to_filename() == filename
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from functools import lru_cache
+import os
 from pathlib import Path
 import re
 from typing import Optional
@@ -84,6 +85,20 @@ class AnnexKey:
         )
         return cls.parse(fields + sep + name)
 
+    def to_filename(self) -> str:
+        """
+        Return the name of the key's object file, the inverse of
+        `parse_filename()`
+        """
+        fields, sep, name = str(self).partition("--")
+        name = (
+            name.replace("&", "&a")
+            .replace("%", "&s")
+            .replace(":", "&c")
+            .replace("/", "%")
+        )
+        return fields + sep + name
+
 
 @dataclass
 class AnnexDir:
@@ -93,7 +108,8 @@ class AnnexDir:
 # might be called twice in rapid succession for an annex key path
 @lru_cache(maxsize=CACHE_SIZE)
 def is_annex_dir_or_key(path: str | Path) -> AnnexDir | AnnexKey | None:
-    parts = list(Path(path).parts)
+    path = os.path.normpath(path)
+    parts = path.split(os.sep)
     start = 0
     while True:
         try:
@@ -103,7 +119,9 @@ def is_annex_dir_or_key(path: str | Path) -> AnnexDir | AnnexKey | None:
         if parts[i + 1 : i + 3] == ["annex", "objects"] and all(
             re.fullmatch(r"[A-Za-z0-9]{2}", p) for p in parts[i + 3 : i + 5]
         ):
-            topdir = str(Path(*parts[:i]))
+            topdir = os.sep.join(parts[:i]) or (
+                os.sep if path.startswith(os.sep) else "."
+            )
             depth = len(parts) - i
             if depth <= 5:  # have only two level of hash'ing directories
                 return AnnexDir(topdir)